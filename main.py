@@ -1,29 +1,206 @@
+import asyncio
+import mmap
+import multiprocessing
 from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
-from docxtpl import DocxTemplate, InlineImage
-from docx.shared import Mm
+from pydantic import BaseModel, Field
 import traceback
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+import shutil
+import socket
 import subprocess
 import tempfile
+import http.client
+import xmlrpc.client
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
 from pathlib import Path
 
 from io import BytesIO
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from cachetools import TTLCache
 import os
-import qrcode
+import segno
 import re
 
 from PIL import Image
+from unoserver.client import UnoClient
 
 from dotenv import load_dotenv
 
+import render
+
 load_dotenv()
 LIBREOFFICE_PATH = os.getenv(
     "LIBREOFFICE_PATH","libreoffice"
 )
+# Python interpreter that can `import uno` (runs the unoserver daemon)
+UNOSERVER_PYTHON = os.getenv("UNOSERVER_PYTHON", "python3")
+UNOSERVER_STARTUP_TIMEOUT = float(os.getenv("UNOSERVER_STARTUP_TIMEOUT", "60"))
+# A hung soffice would block every later conversion in this worker
+UNOSERVER_CONVERSION_TIMEOUT = int(os.getenv("UNOSERVER_CONVERSION_TIMEOUT", "120"))
+# Scratch space for conversions + LibreOffice profiles.
+# Unset → system temp dir. Point it at a tmpfs (e.g. /dev/shm) only when
+# that tmpfs is sized for it — Docker's default /dev/shm is just 64 MB.
+WORK_DIR = os.getenv("WORK_DIR") or None
+
+# -----------------------------
+# LIBREOFFICE DAEMON
+# -----------------------------
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class LibreOfficeDaemon:
+    """
+    Warm LibreOffice (via unoserver) owned by this worker process.
+    - started once at app startup, restarted if it dies
+    - conversions are serialized: one soffice handles one doc at a time
+    - a timed-out conversion makes unoserver exit; a broken connection
+      stops it → either way the next call starts a fresh one
+    """
 
-app = FastAPI()
+    def __init__(self):
+        self.process = None
+        self.port = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Free ports per worker → several gunicorn workers can coexist
+        self.port = _free_port()
+        uno_port = _free_port()
+
+        self.process = subprocess.Popen(
+            [
+                UNOSERVER_PYTHON,
+                "-m",
+                "unoserver.server",
+                "--interface",
+                "127.0.0.1",
+                "--port",
+                str(self.port),
+                "--uno-port",
+                str(uno_port),
+                "--executable",
+                LIBREOFFICE_PATH,
+                "--conversion-timeout",
+                str(UNOSERVER_CONVERSION_TIMEOUT),
+            ]
+            # per-daemon user profile under WORK_DIR → no ~/.config
+            # lock contention between workers
+            + (["--temp-dir", WORK_DIR] if WORK_DIR else [])
+        )
+
+        deadline = time.monotonic() + UNOSERVER_STARTUP_TIMEOUT
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("unoserver exited during startup")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError("unoserver did not start in time")
+                time.sleep(0.5)
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.process = None
+
+    def convert(self, docx_path: Path, pdf_path: Path):
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()  # supervise: bring a crashed daemon back
+
+            try:
+                UnoClient(port=str(self.port)).convert(
+                    inpath=str(docx_path),
+                    outpath=str(pdf_path),
+                    convert_to="pdf",
+                )
+            except (OSError, http.client.HTTPException, xmlrpc.client.ProtocolError):
+                # Daemon unreachable/wedged → restart on the next call.
+                # A Fault (document LibreOffice rejects) keeps it warm.
+                self.stop()
+                raise
+
+libreoffice = LibreOfficeDaemon()
+
+# DOCX rendering is GIL-bound lxml/zipfile work → separate processes, so
+# even one child keeps renders off this worker's event loop + GIL.
+# "spawn" so children never inherit this process's threads/locks; they only
+# import render.py. Sized per gunicorn worker → keep small.
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "1"))
+
+def new_render_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=RENDER_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+RENDER_POOL = new_render_pool()
+
+async def run_in_render_pool(fn, *args):
+    """
+    Run fn in RENDER_POOL; if a child died (OOM kill, lxml crash) the
+    pool is broken for good → rebuild it and retry once.
+    """
+    global RENDER_POOL
+
+    loop = asyncio.get_running_loop()
+    pool = RENDER_POOL
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        if RENDER_POOL is pool:  # first caller to notice rebuilds it
+            pool.shutdown(wait=False, cancel_futures=True)
+            RENDER_POOL = new_render_pool()
+        return await loop.run_in_executor(RENDER_POOL, fn, *args)
+
+# Certificates in flight per worker across all batches: each slot renders,
+# converts and uploads one item at a time → bounded memory + threads, and
+# single /generate-docx calls are never queued behind a whole batch
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "2"))
+
+def batch_slots(app: FastAPI) -> asyncio.Semaphore:
+    """
+    Per-app semaphore for the running loop; a Semaphore binds to the first
+    loop that waits on it, so (re)create it when the loop changes.
+    """
+    loop = asyncio.get_running_loop()
+    slots = getattr(app.state, "batch_slots", None)
+    if slots is None or slots[0] is not loop:
+        slots = app.state.batch_slots = (loop, asyncio.Semaphore(BATCH_CONCURRENCY))
+    return slots[1]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Created here → bound to the loop that serves requests
+    batch_slots(app)
+    await asyncio.to_thread(libreoffice.start)
+    # Spawn + import in the render children now, not on the first request
+    await run_in_render_pool(render.warm_up)
+    try:
+        yield
+    finally:
+        RENDER_POOL.shutdown(wait=False, cancel_futures=True)
+        await asyncio.to_thread(libreoffice.stop)
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # -----------------------------
 # CORS CONFIG
@@ -58,20 +235,42 @@ VERIFY_BASE_URL = os.getenv("VERIFY_BASE_URL")
 if not VERIFY_BASE_URL:
     raise RuntimeError("VERIFY_BASE_URL not set")
 
+R2_MAX_POOL_CONNECTIONS = int(os.getenv("R2_MAX_POOL_CONNECTIONS", "50"))
+
+# Single client shared by all requests; the pool is sized above botocore's
+# default of 10 so concurrent downloads/uploads keep their sockets alive.
 s3 = boto3.client(
     "s3",
     endpoint_url=R2_ENDPOINT,
     aws_access_key_id=R2_ACCESS_KEY_ID,
     aws_secret_access_key=R2_SECRET_ACCESS_KEY,
     region_name="auto",
+    config=Config(
+        max_pool_connections=R2_MAX_POOL_CONNECTIONS,
+        retries={"max_attempts": 3, "mode": "standard"},
+        tcp_keepalive=True,
+    ),
 )
 
+# Templates and signatures rarely change, so keep their raw bytes around and
+# only re-download when the object's ETag moves.
+R2_CACHE_MAX_ITEMS = int(os.getenv("R2_CACHE_MAX_ITEMS", "64"))
+R2_CACHE_TTL_SECONDS = int(os.getenv("R2_CACHE_TTL_SECONDS", "600"))
+
+_blob_cache = TTLCache(maxsize=R2_CACHE_MAX_ITEMS, ttl=R2_CACHE_TTL_SECONDS)
+_blob_cache_lock = threading.Lock()
+
 # -----------------------------
 # HELPERS
 # -----------------------------
 
-def convert_docx_to_pdf(docx_bytes: bytes) -> bytes:
-    with tempfile.TemporaryDirectory() as tmpdir:
+@contextmanager
+def converted_pdf(docx_bytes: bytes):
+    """
+    Convert DOCX → PDF and yield the PDF as a read-only mmap
+    (valid only inside the with-block; the temp dir is removed after).
+    """
+    with tempfile.TemporaryDirectory(dir=WORK_DIR) as tmpdir:
         tmpdir = Path(tmpdir)
 
         docx_path = tmpdir / "input.docx"
@@ -79,48 +278,129 @@ def convert_docx_to_pdf(docx_bytes: bytes) -> bytes:
 
         docx_path.write_bytes(docx_bytes)
 
-        subprocess.run(
-            [
-                LIBREOFFICE_PATH,
-                "--headless",
-                "--nologo",
-                "--nofirststartwizard",
-                "--nodefault",
-                "--nolockcheck",
-                "--norestore",
-                "--convert-to",
-                "pdf",
-                str(docx_path),
-                "--outdir",
-                str(tmpdir),
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
-        )
+        libreoffice.convert(docx_path, pdf_path)
 
-        if not pdf_path.exists():
+        if not pdf_path.exists() or pdf_path.stat().st_size == 0:
             raise RuntimeError("PDF conversion failed")
 
-        return pdf_path.read_bytes()
+        with open(pdf_path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as pdf:
+            yield pdf
+
+def upload_pdf(docx_bytes: bytes, pdf_key: str):
+    # Upload straight from the mapped file → no PDF-sized bytes copy
+    with converted_pdf(docx_bytes) as pdf:
+        upload_to_r2(pdf_key, pdf, "application/pdf")
+
+R2_READ_CHUNK_SIZE = 1024 * 1024
 
-def download_from_r2(key: str) -> bytes:
+def read_body(obj: dict) -> bytes:
+    # Stream the body in 1MB chunks instead of one whole-object read()
+    buf = BytesIO()
+    shutil.copyfileobj(obj["Body"], buf, R2_READ_CHUNK_SIZE)
+    return buf.getvalue()  # hands over BytesIO's buffer, no extra copy
+
+def download_from_r2(key: str) -> tuple[bytes, str]:
     obj = s3.get_object(Bucket=R2_BUCKET_NAME, Key=key)
-    return obj["Body"].read()
-
-def upload_to_r2(key: str, data: bytes):
-    s3.put_object(
-        Bucket=R2_BUCKET_NAME,
-        Key=key,
-        Body=data,
-        ContentType=(
-            "application/vnd.openxmlformats-officedocument."
-            "wordprocessingml.document"
-        ),
+    return read_body(obj), obj["ETag"]
+
+def get_cached(key: str) -> bytes:
+    """
+    Download an R2 object through the in-process cache:
+    - cached entry → HEAD and reuse it if the ETag still matches
+    - otherwise → full GET, then cache (bytes, etag)
+    """
+    with _blob_cache_lock:
+        cached = _blob_cache.get(key)
+
+    if cached is not None:
+        data, etag = cached
+        head = s3.head_object(Bucket=R2_BUCKET_NAME, Key=key)
+        if head["ETag"] == etag:
+            return data
+
+    data, etag = download_from_r2(key)
+
+    with _blob_cache_lock:
+        _blob_cache[key] = (data, etag)
+
+    return data
+
+DOCX_CONTENT_TYPE = (
+    "application/vnd.openxmlformats-officedocument."
+    "wordprocessingml.document"
+)
+
+# Single-part PUT for typical certificates; threads would only add overhead
+R2_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    use_threads=False,
+)
+
+def upload_to_r2(key: str, fileobj, content_type: str = DOCX_CONTENT_TYPE):
+    # Streams from the file object → no extra bytes copy of the document
+    s3.upload_fileobj(
+        fileobj,
+        R2_BUCKET_NAME,
+        key,
+        ExtraArgs={"ContentType": content_type},
+        Config=R2_TRANSFER_CONFIG,
+    )
+
+PRESIGNED_URL_EXPIRES = int(os.getenv("PRESIGNED_URL_EXPIRES", "900"))
+
+def presigned_url(key: str) -> str:
+    # Signed locally (no R2 round-trip) → callers fetch straight from R2
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": R2_BUCKET_NAME, "Key": key},
+        ExpiresIn=PRESIGNED_URL_EXPIRES,
     )
 
+@lru_cache(maxsize=1024)
+def qr_png(verify_url: str) -> bytes:
+    # 30mm inline image → low error correction + small modules are plenty
+    # (make_qr: never fall back to a Micro QR that phones can't scan;
+    #  border=4 is the spec's quiet zone → printed certs stay scannable)
+    qr = segno.make_qr(verify_url, error="L")
+
+    qr_buf = BytesIO()
+    qr.save(qr_buf, kind="png", scale=3, border=4, compresslevel=1)
+    return qr_buf.getvalue()
+
+SIGNATURE_MAX_SIZE = (800, 300)  # max width x height
+
+def prepare_signature(signature_bytes: bytes) -> bytes:
+    img = Image.open(BytesIO(signature_bytes))
+
+    # Already a PNG within bounds → embed the original bytes as-is
+    if (
+        img.format == "PNG"
+        and img.width <= SIGNATURE_MAX_SIZE[0]
+        and img.height <= SIGNATURE_MAX_SIZE[1]
+    ):
+        return signature_bytes
+
+    # 🔽 DOWN-SCALE signature image safely
+    # Ink on paper → grayscale unless the image carries transparency
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+    if has_alpha:
+        img = img.convert("RGBA")   # normalize
+    else:
+        img.draft("L", SIGNATURE_MAX_SIZE)  # JPEG: decode gray at reduced scale
+        if img.mode != "L":
+            img = img.convert("L")
+    img.thumbnail(SIGNATURE_MAX_SIZE, Image.Resampling.BILINEAR)
+
+    sign_buf = BytesIO()
+    img.save(sign_buf, format="PNG", optimize=False, compress_level=1)
+    return sign_buf.getvalue()
+
+import calendar
 from datetime import datetime
 
+@lru_cache(maxsize=4096)
 def format_mmddyyyy(date_str: str) -> str:
     """
     Accepts:
@@ -129,6 +409,20 @@ def format_mmddyyyy(date_str: str) -> str:
     Returns:
     - MM/DD/YYYY
     """
+    # Fast path: plain YYYY-MM-DD without building a datetime
+    if (
+        len(date_str) == 10
+        and date_str.isascii()
+        and date_str[4] == "-"
+        and date_str[7] == "-"
+        and date_str[:4].isdecimal()
+        and date_str[5:7].isdecimal()
+        and date_str[8:].isdecimal()
+    ):
+        year, month, day = int(date_str[:4]), int(date_str[5:7]), int(date_str[8:])
+        if year >= 1000 and 1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1]:
+            return f"{date_str[5:7]}/{date_str[8:]}/{date_str[:4]}"
+
     try:
         dt = datetime.fromisoformat(date_str)
         return dt.strftime("%m/%d/%Y")
@@ -138,11 +432,30 @@ def format_mmddyyyy(date_str: str) -> str:
 # -----------------------------
 # REQUEST SCHEMA
 # -----------------------------
+class CertificateData(BaseModel):
+    certificate_number: str
+    first_name: str
+    middle_name: str = ""
+    last_name: str
+    training_date: str = ""
+    issue_date: str = ""
+    instructor_name: str = ""
+
 class GenerateDocxPayload(BaseModel):
     templateKey: str
     signatureKey: str
     outputKey: str
-    data: dict
+    data: CertificateData
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+
+class GenerateDocxBatchPayload(BaseModel):
+    templateKey: str
+    signatureKey: str
+    items: list[CertificateData] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+
+_WS_RE = re.compile(r"\s+")
+_UNSAFE_RE = re.compile(r"[^a-zA-Z0-9_]")
 
 def safe_part(value: str) -> str:
     """
@@ -150,10 +463,71 @@ def safe_part(value: str) -> str:
     - remove special chars
     - replace spaces with underscore
     """
-    value = value.strip()
-    value = re.sub(r"\s+", "_", value)
-    value = re.sub(r"[^a-zA-Z0-9_]", "", value)
-    return value
+    return _UNSAFE_RE.sub("", _WS_RE.sub("_", value.strip()))
+
+def check_internal_api_key(request: Request):
+    api_key = request.headers.get("x-internal-api-key")
+
+    if api_key != INTERNAL_API_KEY:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+def certificate_pdf_key(data: CertificateData) -> str:
+    """
+    Validate the name/number fields and build the R2 key:
+    - certificates/<cert>_<first>[_<middle>]_<last>.pdf
+    Runs before touching R2 → bad payloads cost no downloads.
+    """
+    if not data.certificate_number:
+        raise HTTPException(400, "certificate_number missing")
+
+    cert_no = safe_part(data.certificate_number)
+    first = safe_part(data.first_name)
+    middle = safe_part(data.middle_name)
+    last = safe_part(data.last_name)
+
+    if not cert_no or not first or not last:
+        raise HTTPException(400, "certificate_number, first_name and last_name are required")
+
+    filename_parts = [cert_no, first]
+
+    if middle:
+        filename_parts.append(middle)
+
+    filename_parts.append(last)
+
+    filename = "_".join(filename_parts) + ".pdf"
+
+    # Optional: put into a folder
+    return f"certificates/{filename}"
+
+def certificate_verify_url(data: CertificateData) -> str:
+    return f"{VERIFY_BASE_URL.rstrip('/')}/{data.certificate_number}"
+
+async def render_certificate(
+    template_bytes: bytes,
+    qr_bytes: bytes,
+    signature_png: bytes,
+    data: CertificateData,
+) -> bytes:
+    # Context (TEXT; QR + SIGNATURE are added by render.render_docx)
+    context = {
+        "first_name": data.first_name,
+        "middle_name": data.middle_name,
+        "last_name": data.last_name,
+        "training_date": format_mmddyyyy(data.training_date),
+        "issue_date": format_mmddyyyy(data.issue_date),
+        "certificate_number": data.certificate_number,
+        "instructor_name": data.instructor_name,
+    }
+
+    # Render + save DOCX to memory (in RENDER_POOL)
+    return await run_in_render_pool(
+        render.render_docx,
+        template_bytes,
+        qr_bytes,
+        signature_png,
+        context,
+    )
 
 # -----------------------------
 # ROUTES
@@ -163,107 +537,99 @@ def health():
     return {"status": "ok"}
 
 @app.post("/generate-docx")
-def generate_docx(payload: GenerateDocxPayload, request: Request):
-    api_key = request.headers.get("x-internal-api-key")
+async def generate_docx(payload: GenerateDocxPayload, request: Request):
+    check_internal_api_key(request)
 
-    if api_key != INTERNAL_API_KEY:
-        raise HTTPException(status_code=403, detail="Forbidden")
+    pdf_key = certificate_pdf_key(payload.data)
 
     try:
-        # 1️⃣ Download template
-        template_bytes = download_from_r2(payload.templateKey)
-        tpl = DocxTemplate(BytesIO(template_bytes))
-
-        # 2️⃣ Generate QR
-        cert_no = payload.data.get("certificate_number", "")
-        if not cert_no:
-            raise HTTPException(400, "certificate_number missing")
-
-        verify_url = f"{VERIFY_BASE_URL.rstrip('/')}/{cert_no}"
-        qr_img = qrcode.make(verify_url)
-        qr_buf = BytesIO()
-        qr_img.save(qr_buf, format="PNG")
-        qr_buf.seek(0)
-
-
-        # 3️⃣ Download instructor signature
-        signature_bytes = download_from_r2(payload.signatureKey)
-
-        # 🔽 DOWN-SCALE signature image safely
-        img = Image.open(BytesIO(signature_bytes))
-        img = img.convert("RGBA")   # normalize
-        img.thumbnail((800, 300))   # max width x height
-
-        sign_buf = BytesIO()
-        img.save(sign_buf, format="PNG")
-        sign_buf.seek(0)
-
-
-
-        # 4️⃣ Context (TEXT + QR + SIGNATURE)
-        context = {
-            "first_name": payload.data.get("first_name", ""),
-            "middle_name": payload.data.get("middle_name", ""),
-            "last_name": payload.data.get("last_name", ""),
-            "training_date": format_mmddyyyy(
-                payload.data.get("training_date", "")
-            ),
-            "issue_date": format_mmddyyyy(
-                payload.data.get("issue_date", "")
-            ),
-            "certificate_number": payload.data.get("certificate_number", ""),
-            "instructor_name": payload.data.get("instructor_name", ""),
-            "qr_code": InlineImage(tpl, qr_buf, width=Mm(30)),
-            "instructor_signature": InlineImage(
-                tpl, sign_buf, width=Mm(30)
-            ),
-        }
-
+        # 1️⃣ Download template + instructor signature (in parallel)
+        template_bytes, signature_bytes = await asyncio.gather(
+            asyncio.to_thread(get_cached, payload.templateKey),
+            asyncio.to_thread(get_cached, payload.signatureKey),
+        )
 
-        tpl.render(context)
+        # 2️⃣ Generate QR + 3️⃣ down-scale signature (off the event loop)
+        qr_bytes, signature_png = await asyncio.gather(
+            asyncio.to_thread(qr_png, certificate_verify_url(payload.data)),
+            asyncio.to_thread(prepare_signature, signature_bytes),
+        )
 
-        # 5️⃣ Save DOCX to memory
-        out = BytesIO()
-        tpl.save(out)
-        out.seek(0)
+        # 4️⃣ Render DOCX
+        docx_bytes = await render_certificate(
+            template_bytes, qr_bytes, signature_png, payload.data
+        )
 
-        cert_no = safe_part(payload.data.get("certificate_number", ""))
-        first = safe_part(payload.data.get("first_name", ""))
-        middle = safe_part(payload.data.get("middle_name", ""))
-        last = safe_part(payload.data.get("last_name", ""))
+        # 5️⃣ Convert DOCX → PDF + upload PDF
+        await asyncio.to_thread(upload_pdf, docx_bytes, pdf_key)
 
-        if not cert_no or not first or not last:
-            raise HTTPException(400, "certificate_number, first_name and last_name are required")
+        return {"key": pdf_key, "url": presigned_url(pdf_key)}
 
-        filename_parts = [cert_no, first]
 
-        if middle:
-            filename_parts.append(middle)
 
-        filename_parts.append(last)
+    except Exception as e:
+        traceback.print_exc() 
+        raise HTTPException(status_code=500, detail=str(e))
 
-        filename = "_".join(filename_parts) + ".docx"
+@app.post("/generate-docx-batch")
+async def generate_docx_batch(payload: GenerateDocxBatchPayload, request: Request):
+    """
+    Many certificates, one template + signature:
+    - template/signature downloaded and prepared once
+    - each item is rendered, converted and uploaded as soon as a batch
+      slot is free (BATCH_CONCURRENCY per worker)
+    - per-item result: {"key", "url"} or {"key", "error"}; 207 if any failed
+    """
+    check_internal_api_key(request)
 
-        # Optional: put into a folder
-        output_key = f"certificates/{filename}"
+    pdf_keys = [certificate_pdf_key(item) for item in payload.items]
 
-        # Convert DOCX → PDF
-        pdf_bytes = convert_docx_to_pdf(out.getvalue())
+    # Same key → the later item would silently overwrite the earlier one
+    if len(set(pdf_keys)) != len(pdf_keys):
+        raise HTTPException(400, "duplicate certificate in batch")
 
-        pdf_key = output_key.replace(".docx", ".pdf")
+    slots = batch_slots(request.app)
 
-        # Upload PDF
-        s3.put_object(
-            Bucket=R2_BUCKET_NAME,
-            Key=pdf_key,
-            Body=pdf_bytes,
-            ContentType="application/pdf",
+    try:
+        template_bytes, signature_bytes = await asyncio.gather(
+            asyncio.to_thread(get_cached, payload.templateKey),
+            asyncio.to_thread(get_cached, payload.signatureKey),
         )
 
-        return {"key": pdf_key}
+        signature_png = await asyncio.to_thread(prepare_signature, signature_bytes)
+
+        async def generate_item(item: CertificateData, pdf_key: str):
+            async with slots:
+                qr_bytes = await asyncio.to_thread(
+                    qr_png, certificate_verify_url(item)
+                )
+                docx_bytes = await render_certificate(
+                    template_bytes, qr_bytes, signature_png, item
+                )
+                await asyncio.to_thread(upload_pdf, docx_bytes, pdf_key)
+
+        # Every item runs to completion → nothing is still uploading once
+        # the response goes out, and each item reports its own outcome
+        results = await asyncio.gather(
+            *(
+                generate_item(item, pdf_key)
+                for item, pdf_key in zip(payload.items, pdf_keys)
+            ),
+            return_exceptions=True,
+        )
 
+        items = []
+        for pdf_key, result in zip(pdf_keys, results):
+            if isinstance(result, BaseException):
+                traceback.print_exception(result)
+                items.append({"key": pdf_key, "error": str(result)})
+            else:
+                items.append({"key": pdf_key, "url": presigned_url(pdf_key)})
 
+        failed = any("error" in item for item in items)
+        # 207 → some items failed; retry only the ones carrying "error"
+        return ORJSONResponse({"items": items}, status_code=207 if failed else 200)
 
     except Exception as e:
-        traceback.print_exc() 
+        traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
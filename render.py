@@ -0,0 +1,67 @@
+"""
+DOCX rendering, run inside main.RENDER_POOL's child processes.
+
+Kept apart from main.py so a spawned child only imports this (docxtpl +
+jinja) — not the FastAPI app, the R2 client or another process pool.
+"""
+from io import BytesIO
+
+from cachetools import LRUCache
+from docx.shared import Mm
+from docxtpl import DocxTemplate, InlineImage
+from jinja2 import Environment
+
+class CachingEnvironment(Environment):
+    """
+    Jinja env that memoizes from_string():
+    - docxtpl compiles every XML part with from_string() on each render
+    - the patched XML is identical for the same template version
+    → parse + compile once per process, then reuse the Template
+    """
+
+    def __init__(self, *args, compiled_cache_size: int = 64, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._compiled = LRUCache(maxsize=compiled_cache_size)
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals is not None or template_class is not None:
+            return super().from_string(source, globals, template_class)
+
+        template = self._compiled.get(source)
+        if template is None:
+            template = super().from_string(source)
+            self._compiled[source] = template
+        return template
+
+# One per render process (module-level → created on import in each worker)
+JINJA_ENV = CachingEnvironment(autoescape=False)
+
+def render_docx(
+    template_bytes: bytes,
+    qr_bytes: bytes,
+    signature_bytes: bytes,
+    context: dict,
+) -> bytes:
+    """
+    Runs in main.RENDER_POOL → arguments and result must be picklable,
+    so the InlineImages are built here.
+    """
+    # DocxTemplate mutates on render → always wrap a fresh one
+    tpl = DocxTemplate(BytesIO(template_bytes))
+
+    context = {
+        **context,
+        "qr_code": InlineImage(tpl, BytesIO(qr_bytes), width=Mm(30)),
+        "instructor_signature": InlineImage(
+            tpl, BytesIO(signature_bytes), width=Mm(30)
+        ),
+    }
+    tpl.render(context, jinja_env=JINJA_ENV)
+
+    out = BytesIO()
+    tpl.save(out)
+    return out.getvalue()
+
+def warm_up():
+    # No-op: submitting it makes the pool spawn its children + import this
+    return None